@@ -21,6 +21,8 @@ sudo apt-get install git -y
 
 #websockets for radar
 sudo pip3 install websockets
+# optional, faster json parsing, radar falls back to standard json if not available
+sudo pip3 install orjson
 
 # espeak-ng for sound output
 sudo apt-get update
@@ -47,6 +47,11 @@ import shutdownui
 import ahrsui
 import statusui
 import importlib
+from operator import itemgetter
+try:
+    import orjson as _json   # considerably faster parser for traffic and situation messages
+except ImportError:
+    import json as _json
 
 # constant definitions
 RADAR_VERSION = "1.0d"
@@ -54,15 +59,26 @@ RADAR_VERSION = "1.0d"
 RETRY_TIMEOUT = 1
 LOST_CONNECTION_TIMEOUT = 0.3
 RADAR_CUTOFF = 29
+CUTOFF_CHECK_TIME = 1.0   # interval in seconds to check for outdated traffic
 UI_REACTION_TIME = 0.1
 MINIMAL_WAIT_TIME = 0.01   # give other coroutines some time to to their jobs
+TRAFFIC_BATCH_TIME = 0.02   # maximum time traffic messages are collected before they are processed
+MAX_TRAFFIC_BATCH = 32   # maximum number of traffic messages processed in one batch
 BLUEZ_CHECK_TIME = 3.0
 SPEED_ARROW_TIME = 60  # time in seconds for the line that displays the speed
 WATCHDOG_TIMER = 3.0   # time after "no connection" is assumed, if no new situation is received
+IDLE_WAKEUP_TIME = 1.0   # max wait for a redraw event in radar mode, must stay below WATCHDOG_TIMER
 CHECK_CONNECTION_TIMEOUT = 5.0
 # timeout used for regular status request, necessary towards stratux to keep the websockets open
 MIN_DISPLAY_REFRESH_TIME = 0.1
 # minimal time to wait for a display refresh, to give time for situation and traffic
+RADIUS_EARTH_NM = 6371008.8 / 1852   # mean earth radius in nautical miles
+ALT_EPS = 1.0   # minimal change of own altitude in feet to trigger a display refresh
+POS_EPS = 1e-5   # minimal change of own position in degrees (about 1 m) to trigger a display refresh
+
+# lookup tables for sin/cos of bearings, resolution of one degree is sufficient for display
+_SIN_LUT = tuple(math.sin(math.radians(d)) for d in range(360))
+_COS_LUT = tuple(math.cos(math.radians(d)) for d in range(360))
 
 # global variables
 DEFAULT_URL_HOST_BASE = "192.168.10.1"
@@ -74,8 +90,10 @@ url_status_get = ""
 device = ""
 draw = None
 all_ac = {}
+traffic_queue = None   # asyncio.Queue of received traffic messages, processed in batches, created in courotines
 aircraft_changed = True
 ui_changed = True
+redraw_event = None   # asyncio.Event, set whenever the radar display needs to be redrawn, created in courotines
 situation = {'was_changed': True, 'last_update': 0.0,  'connected': False, 'gps_active': False, 'course': 0,
              'own_altitude': -99.0, 'latitude': 0.0, 'longitude': 0.0, 'RadarRange': 5, 'RadarLimits': 10000,
              'gps_quality': 0, 'gps_h_accuracy': 20000}
@@ -84,6 +102,7 @@ ahrs = {'was_changed': True, 'pitch': 0, 'roll': 0, 'heading': 0, 'slipskid': 0,
 # ahrs information, values are all rounded to integer
 
 max_pixel = 0
+px_per_nm = 0.0   # display scale, pixels per nautical mile for the current radar range
 zerox = 0
 zeroy = 0
 last_arcposition = 0
@@ -99,67 +118,62 @@ bluetooth_active = False
 
 
 def draw_all_ac(draw, allac):
-    dist_sorted = sorted(allac.items(), key=lambda el: el[1]['gps_distance'], reverse=True)
-    for icao, ac in dist_sorted:
+    if not allac:
+        return
+    modes = []
+    adsb = []
+    for ac in allac.values():
+        # only sort and draw what is on the screen
+        if 'circradius' in ac and ac['circradius'] <= max_pixel / 2:
+            modes.append(ac)
+        if 'x' in ac and 0 < ac['x'] <= max_pixel and ac['y'] <= max_pixel:
+            adsb.append(ac)
+    modes.sort(key=itemgetter('gps_distance'), reverse=True)
+    adsb.sort(key=itemgetter('gps_distance'), reverse=True)
+    for ac in modes:
         # first draw mode-s
-        if 'circradius' in ac:
-            if ac['circradius'] <= max_pixel / 2:
-                display_control.modesaircraft(draw, ac['circradius'], ac['height'], ac['arcposition'])
-    for icao, ac in dist_sorted:
+        display_control.modesaircraft(draw, ac['circradius'], ac['height'], ac['arcposition'])
+    for ac in adsb:
         # then draw adsb
-        if 'x' in ac:
-            if 0 < ac['x'] <= max_pixel and ac['y'] <= max_pixel:
-                if 'nspeed_length' in ac:
-                    line_length = ac['nspeed_length']
-                else:
-                    line_length = 0
-                display_control.aircraft(draw, ac['x'], ac['y'], ac['direction'], ac['height'], ac['vspeed'],
-                                         line_length)
-
-
-def draw_display(draw):
-    global all_ac
-    global situation
-    global aircraft_changed
-    global ui_changed
+        display_control.aircraft(draw, ac['x'], ac['y'], ac['direction'], ac['height'], ac['vspeed'],
+                                 ac.get('nspeed_length', 0))
+
 
-    logging.debug("List of all aircraft > " + json.dumps(all_ac))
-    if situation['was_changed'] or aircraft_changed or ui_changed:
-        # display is only triggered if there was a change
-        display_control.clear(draw)
-        display_control.situation(draw, situation['connected'], situation['gps_active'], situation['own_altitude'],
-                                  situation['course'], situation['RadarRange'], situation['RadarLimits'], bt_devices,
-                                  sound_on, situation['gps_quality'], situation['gps_h_accuracy'])
-        draw_all_ac(draw, all_ac)
-        display_control.display()
-        situation['was_changed'] = False
-        aircraft_changed = False
-        ui_changed = False
-
-
-def radians_rel(angle):
+def draw_display(draw, allac, sit, bt_dev, sound):
+    # runs in an executor thread, so only works on the snapshots passed in
+    display_control.clear(draw)
+    display_control.situation(draw, sit['connected'], sit['gps_active'], sit['own_altitude'], sit['course'],
+                              sit['RadarRange'], sit['RadarLimits'], bt_dev, sound, sit['gps_quality'],
+                              sit['gps_h_accuracy'])
+    draw_all_ac(draw, allac)
+    display_control.display()
+
+
+def radians_rel(angle, _radians=math.radians):
     if angle > 180:
         angle = angle - 360
     if angle <= -180:
         angle = angle + 360
-    return angle * math.pi / 180
-
-
-def calc_gps_distance(lat, lng):
-    radius_earth = 6371008.8
-    avglat = radians_rel((situation['latitude'] + lat) / 2)
-    distlat = (radians_rel(lat - situation['latitude']) * radius_earth) / 1852
-    distlng = ((radians_rel(lng - situation['longitude']) * radius_earth) / 1852) * abs(math.cos(avglat))
-    distradius = math.sqrt((distlat * distlat) + (distlng * distlng))
-    if distlat < 0:
-        angle = math.degrees(math.pi - math.atan(distlng / (-distlat)))
-    elif distlat > 0:
-        angle = math.degrees(-math.atan(distlng / (-distlat)))
-    else:
-        angle = 0
+    return _radians(angle)
+
+
+def calc_gps_distance(lat, lng, _radians=math.radians, _cos=math.cos, _hypot=math.hypot, _atan2=math.atan2,
+                      _degrees=math.degrees):
+    # math functions bound as default arguments for faster local access, called for every traffic message
+    # latitudes stay within [-90, 90], only the longitude difference may wrap around
+    avglat = _radians((situation['latitude'] + lat) / 2)
+    distlat = _radians(lat - situation['latitude']) * RADIUS_EARTH_NM
+    distlng = radians_rel(lng - situation['longitude']) * RADIUS_EARTH_NM * abs(_cos(avglat))
+    distradius = _hypot(distlat, distlng)
+    angle = _degrees(_atan2(distlng, distlat))   # true bearing, north = 0, east = 90
     return distradius, angle
 
 
+def _iround(v):
+    # round half away from zero, cheaper than round() for pixel coordinates
+    return int(v + 0.5) if v >= 0 else -int(-v + 0.5)
+
+
 def speaktraffic(hdiff, direction=None):
     if sound_on:
         feet = hdiff * 100
@@ -173,17 +187,18 @@ def speaktraffic(hdiff, direction=None):
         radarbluez.speak(txt)
 
 
-def new_traffic(json_str):
+def new_traffic(traffic, _time=time.time, _iround=_iround):
     global last_arcposition
     global aircraft_changed
+    global px_per_nm
 
     aircraft_changed = True
-    logging.debug("New Traffic" + json_str)
-    traffic = json.loads(json_str)
+    redraw_event.set()
     changed = False
     if 'RadarRange' in traffic or 'RadarLimits' in traffic:
         if situation['RadarRange'] != traffic['RadarRange']:
             situation['RadarRange'] = traffic['RadarRange']
+            px_per_nm = max_pixel / (2 * situation['RadarRange'])
             changed = True
         if situation['RadarLimits'] != traffic['RadarLimits']:
             situation['RadarLimits'] = traffic['RadarLimits']
@@ -195,19 +210,24 @@ def new_traffic(json_str):
         # ignore rest of message
     if 'Icao_addr' not in traffic:
         # steering message without aircraft content
-        logging.debug("No Icao_addr in message" + json_str)
+        logging.debug("No Icao_addr in message" + str(traffic))
         return
 
-    is_new = False
-    if traffic['Icao_addr'] not in all_ac.keys():
-        # new traffic, insert
-        all_ac[traffic['Icao_addr']] = {'gps_distance': 0, 'was_spoken': False}
-        is_new = True
-    ac = all_ac[traffic['Icao_addr']]
+    radar_range = situation['RadarRange']
+    course = situation['course']
     if traffic['Age'] <= traffic['AgeLastAlt']:
-        ac['last_contact_timestamp'] = time.time() - traffic['Age']
+        last_contact = _time() - traffic['Age']
     else:
-        ac['last_contact_timestamp'] = time.time() - traffic['AgeLastAlt']
+        last_contact = _time() - traffic['AgeLastAlt']
+    # read before inserting, so that every aircraft in all_ac has a timestamp for the cutoff
+    icao = traffic['Icao_addr']
+    ac = all_ac.get(icao)
+    is_new = ac is None
+    if is_new:
+        # new traffic, insert
+        ac = {'gps_distance': 0, 'was_spoken': False}
+        all_ac[icao] = ac
+    ac['last_contact_timestamp'] = last_contact
     ac['height'] = round((traffic['Alt'] - situation['own_altitude']) / 100)
 
     if traffic['Speed_valid']:
@@ -216,37 +236,34 @@ def new_traffic(json_str):
 
     if traffic['Position_valid'] and situation['gps_active']:
         # adsb traffic and stratux has valid gps signal
-        logging.debug('RADAR: ADSB traffic ' + hex(traffic['Icao_addr']) + " at height " + str(ac['height']))
+        logging.debug('RADAR: ADSB traffic ' + hex(icao) + " at height " + str(ac['height']))
         if 'circradius' in ac:
             del ac['circradius']
             # was mode-s target before, now invalidate mode-s info
         gps_rad, gps_angle = calc_gps_distance(traffic['Lat'], traffic['Lng'])
         ac['gps_distance'] = gps_rad
         if 'Track' in traffic:
-            ac['direction'] = traffic['Track'] - situation['course']
+            ac['direction'] = traffic['Track'] - course
             # sometimes track is missing, than leave it as it is
-        if gps_rad <= situation['RadarRange'] and abs(ac['height']) <= situation['RadarLimits']:
-            res_angle = gps_angle - situation['course']
-            gpsx = math.sin(math.radians(res_angle)) * gps_rad
-            gpsy = - math.cos(math.radians(res_angle)) * gps_rad
-            ac['x'] = round(max_pixel / 2 * gpsx / situation['RadarRange'] + zerox)
-            ac['y'] = round(max_pixel / 2 * gpsy / situation['RadarRange'] + zeroy)
+        if gps_rad <= radar_range and abs(ac['height']) <= situation['RadarLimits']:
+            res_angle = gps_angle - course
+            idx = round(res_angle) % 360
+            gpsx = _SIN_LUT[idx] * gps_rad
+            gpsy = - _COS_LUT[idx] * gps_rad
+            ac['x'] = _iround(px_per_nm * gpsx + zerox)
+            ac['y'] = _iround(px_per_nm * gpsy + zeroy)
             if 'nspeed' in ac:
                 nspeed_rad = ac['nspeed'] * SPEED_ARROW_TIME / 3600  # distance in nm in that time
-                ac['nspeed_length'] = round(max_pixel / 2 * nspeed_rad / situation['RadarRange'])
+                ac['nspeed_length'] = _iround(px_per_nm * nspeed_rad)
             # speech output
-            if gps_rad <= situation['RadarRange'] / 2:
-                oclock = round(res_angle / 30)
-                if oclock <= 0:
-                    oclock += 12
-                if oclock > 12:
-                    oclock -= 12
+            if gps_rad <= radar_range / 2:
+                oclock = (round(res_angle / 30) - 1) % 12 + 1   # 1 .. 12, also for negative angles
                 if not ac['was_spoken']:
                     speaktraffic(ac['height'], oclock)
                     ac['was_spoken'] = True
             else:
                 # implement hysteresis, speak traffic again if aircraft was once outside 3/4 of display radius
-                if gps_rad >= situation['RadarRange'] * 0.75:
+                if gps_rad >= radar_range * 0.75:
                     ac['was_spoken'] = False
         else:
             # do not display
@@ -260,8 +277,8 @@ def new_traffic(json_str):
             return
             # unspecified altitude, nothing displayed for now, leave it as it is
         distcirc = traffic['DistanceEstimated'] / 1852.0
-        logging.debug("RADAR: Mode-S traffic " + hex(traffic['Icao_addr']) + " in " + str(distcirc) + " nm")
-        distx = round(max_pixel / 2 * distcirc / situation['RadarRange'])
+        logging.debug("RADAR: Mode-S traffic " + hex(icao) + " in " + str(distcirc) + " nm")
+        distx = _iround(px_per_nm * distcirc)
         if is_new or 'circradius' not in ac:
             # calc argposition if new or adsb before
             last_arcposition = display_control.next_arcposition(last_arcposition)   # display specific
@@ -269,23 +286,65 @@ def new_traffic(json_str):
         ac['gps_distance'] = distcirc
         ac['circradius'] = distx
 
-        if ac['gps_distance'] <= situation['RadarRange'] / 2:
+        if ac['gps_distance'] <= radar_range / 2:
             if not ac['was_spoken']:
                 speaktraffic(ac['height'])
                 ac['was_spoken'] = True
         else:
             # implement hysteresis, speak traffic again if aircraft was once outside 3/4 of display radius
-            if ac['gps_distance'] > situation['RadarRange'] * 0.75:
+            if ac['gps_distance'] > radar_range * 0.75:
                 ac['was_spoken'] = False
 
 
-def new_situation(json_str):
+def process_traffic_message(traffic):
+    # a single malformed message must not terminate traffic processing
+    try:
+        new_traffic(traffic)
+    except (ValueError, KeyError, TypeError) as e:
+        logging.debug("Traffic: ignoring invalid message (" + repr(e) + "): " + str(traffic))
+
+
+def queue_traffic(json_str):
+    traffic_queue.put_nowait(json_str)
+
+
+async def process_traffic():
+    try:
+        while True:
+            batch = [await traffic_queue.get()]
+            await asyncio.sleep(TRAFFIC_BATCH_TIME)   # collect further messages of a burst
+            while len(batch) < MAX_TRAFFIC_BATCH and not traffic_queue.empty():
+                batch.append(traffic_queue.get_nowait())
+            latest = {}   # only the newest message per aircraft is relevant
+            for json_str in batch:
+                try:
+                    logging.debug("New Traffic" + json_str)
+                    traffic = _json.loads(json_str)
+                    if 'Icao_addr' in traffic:
+                        latest[traffic['Icao_addr']] = traffic
+                        continue
+                except (ValueError, KeyError, TypeError) as e:
+                    logging.debug("Traffic: ignoring invalid message (" + repr(e) + "): " + str(json_str))
+                    continue
+                # steering message, e.g. range change: first process the aircraft received before it
+                for ac_traffic in latest.values():
+                    process_traffic_message(ac_traffic)
+                latest.clear()
+                process_traffic_message(traffic)
+            for ac_traffic in latest.values():
+                process_traffic_message(ac_traffic)
+    except asyncio.CancelledError:
+        print("Traffic task terminating ...")
+        logging.debug("Traffic task terminating ...")
+
+
+def new_situation(json_str, _time=time.time):
     global situation
     global ahrs
 
     logging.debug("New Situation" + json_str)
-    sit = json.loads(json_str)
-    situation['last_update'] = time.time()
+    sit = _json.loads(json_str)
+    situation['last_update'] = _time()
     if not situation['connected']:
         situation['connected'] = True
         situation['was_changed'] = True
@@ -297,13 +356,13 @@ def new_situation(json_str):
     if situation['course'] != round(sit['GPSTrueCourse']):
         situation['course'] = round(sit['GPSTrueCourse'])
         situation['was_changed'] = True
-    if situation['own_altitude'] != sit['BaroPressureAltitude']:
+    if abs(situation['own_altitude'] - sit['BaroPressureAltitude']) >= ALT_EPS:
         situation['own_altitude'] = sit['BaroPressureAltitude']
         situation['was_changed'] = True
-    if situation['latitude'] != sit['GPSLatitude']:
+    if abs(situation['latitude'] - sit['GPSLatitude']) >= POS_EPS:
         situation['latitude'] = sit['GPSLatitude']
         situation['was_changed'] = True
-    if situation['longitude'] != sit['GPSLongitude']:
+    if abs(situation['longitude'] - sit['GPSLongitude']) >= POS_EPS:
         situation['longitude'] = sit['GPSLongitude']
         situation['was_changed'] = True
     if situation['gps_quality'] != sit['GPSFixQuality']:
@@ -312,6 +371,8 @@ def new_situation(json_str):
     if situation['gps_h_accuracy'] != sit['GPSHorizontalAccuracy']:
         situation['gps_h_accuracy'] = sit['GPSHorizontalAccuracy']
         situation['was_changed'] = True
+    if situation['was_changed']:
+        redraw_event.set()
 
     if ahrs['pitch'] != round(sit['AHRSPitch']):
         ahrs['pitch'] = round(sit['AHRSPitch'])
@@ -377,6 +438,7 @@ async def listen_forever(path, name, callback):
                 situation['connected'] = False
                 ahrs['was_changed'] = True
                 situation['was_changed'] = True
+                redraw_event.set()
             await asyncio.sleep(RETRY_TIMEOUT)
             continue
 
@@ -402,6 +464,7 @@ async def user_interface():
                     else:
                         radarbluez.speak("Radar sound off")
                     ui_changed = True
+                    redraw_event.set()
             elif global_mode == 2:  # Timer mode
                 next_mode = timerui.user_input()
             elif global_mode == 3:  # shutdown mode
@@ -416,6 +479,7 @@ async def user_interface():
 
             if next_mode > 0:
                 ui_changed = True
+                redraw_event.set()
                 global_mode = next_mode
 
             current_time = time.time()
@@ -428,6 +492,7 @@ async def user_interface():
                         radarbluez.speak("Radar connected")
                     bt_devices = new_devices
                     ui_changed = True
+                    redraw_event.set()
     except asyncio.CancelledError:
         print("UI task terminating ...")
         logging.debug("Display task terminating ...")
@@ -435,18 +500,39 @@ async def user_interface():
 
 async def display_and_cutoff():
     global aircraft_changed
+    global ui_changed
     global global_mode
     global display_control
 
+    last_cutoff_check = 0.0
     try:
         while True:
+            if global_mode == 1 and not (situation['was_changed'] or aircraft_changed or ui_changed):
+                # radar mode and nothing to display, wait for a change instead of polling
+                # timeout keeps cutoff and watchdog running if no messages are received
+                try:
+                    await asyncio.wait_for(redraw_event.wait(), timeout=IDLE_WAKEUP_TIME)
+                except asyncio.TimeoutError:
+                    pass
+                redraw_event.clear()
             await asyncio.sleep(MIN_DISPLAY_REFRESH_TIME)
             if display_control.is_busy():
                 await asyncio.sleep(display_refresh_time / 3)
                 # try it several times to be as fast as possible
             else:
                 if global_mode == 1:   # Radar
-                    draw_display(draw)
+                    if situation['was_changed'] or aircraft_changed or ui_changed:
+                        # display is only triggered if there was a change
+                        if logging.getLogger().isEnabledFor(logging.DEBUG):
+                            logging.debug("List of all aircraft > " + json.dumps(all_ac))
+                        # snapshot state, so that traffic and situation can be processed while drawing
+                        sit = dict(situation)
+                        allac = {icao: dict(ac) for icao, ac in all_ac.items()}
+                        situation['was_changed'] = False
+                        aircraft_changed = False
+                        ui_changed = False
+                        await asyncio.get_running_loop().run_in_executor(None, draw_display, draw, allac, sit,
+                                                                         bt_devices, sound_on)
                 elif global_mode == 2:   # Timer'
                     timerui.draw_timer(draw, display_control, display_refresh_time)
                 elif global_mode == 3:   # shutdown
@@ -469,15 +555,17 @@ async def display_and_cutoff():
                 elif global_mode == 7:  # status display
                     statusui.draw_status(draw, display_control, bluetooth_active)
 
-            to_delete = []
-            cutoff = time.time() - RADAR_CUTOFF
-            for icao, ac in all_ac.items():
-                if ac['last_contact_timestamp'] < cutoff:
-                    logging.debug("Cutting of " + hex(icao))
-                    to_delete.append(icao)
+            current_time = time.time()
+            if current_time > last_cutoff_check + CUTOFF_CHECK_TIME:
+                # traffic is kept for RADAR_CUTOFF seconds, no need to scan on every display cycle
+                last_cutoff_check = current_time
+                cutoff = current_time - RADAR_CUTOFF
+                to_delete = [icao for icao, ac in all_ac.items() if ac['last_contact_timestamp'] < cutoff]
+                if to_delete:
+                    for icao in to_delete:
+                        logging.debug("Cutting of " + hex(icao))
+                        del all_ac[icao]
                     aircraft_changed = True
-            for i in to_delete:
-                del all_ac[i]
 
             # watchdog
             if situation['last_update'] + WATCHDOG_TIMER < time.time():
@@ -492,13 +580,19 @@ async def display_and_cutoff():
 
 
 async def courotines():
-    await asyncio.wait([listen_forever(url_radar_ws, "TrafficHandler", new_traffic),
-                        listen_forever(url_situation_ws, "SituationHandler", new_situation),
-                        display_and_cutoff(), user_interface()])
+    global redraw_event
+    global traffic_queue
+
+    redraw_event = asyncio.Event()   # created here to be bound to the running event loop
+    traffic_queue = asyncio.Queue()
+    await asyncio.gather(listen_forever(url_radar_ws, "TrafficHandler", queue_traffic),
+                         listen_forever(url_situation_ws, "SituationHandler", new_situation),
+                         process_traffic(), display_and_cutoff(), user_interface())
 
 
 def main():
     global max_pixel
+    global px_per_nm
     global zerox
     global zeroy
     global draw
@@ -509,6 +603,7 @@ def main():
     if speak:
         bluetooth_active = radarbluez.bluez_init()
     draw, max_pixel, zerox, zeroy, display_refresh_time = display_control.init()
+    px_per_nm = max_pixel / (2 * situation['RadarRange'])
     ahrsui.init(display_control)
     statusui.init(display_control, url_status_get, url_host_base, display_refresh_time)
     display_control.startup(draw, RADAR_VERSION, url_host_base, 4)
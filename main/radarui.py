@@ -61,7 +61,7 @@ def communicate_limits(radarrange, threshold):
         logging.debug("Posting limits exception", e)
 
 
-def user_input(rrange, rlimits):   # return Nextmode, toogleSound  (Bool)
+def user_input(rrange, rlimits):   # return Nextmode (0 = no change), toogleSound  (Bool)
     try:
         radius = display_radius.index(rrange)
         height = height_diff.index(rlimits)
@@ -71,7 +71,7 @@ def user_input(rrange, rlimits):   # return Nextmode, toogleSound  (Bool)
 
     btime, button = radarbuttons.check_buttons()
     if btime == 0:
-        return 1, False
+        return 0, False  # stay in radar mode, nothing changed
     if button == 0:
         if btime == 2:    # left and long
             return 3, False  # start next mode shutdown!
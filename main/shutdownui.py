@@ -32,8 +32,8 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import logging
-import os
 import radarbuttons
+import subprocess
 import time
 
 SHUTDOWN_WAIT_TIME = 6.0
@@ -55,7 +55,8 @@ def draw_shutdown(draw, display_control):
         logging.debug("Cleaning display")
         display_control.cleanup()
         logging.debug("Display driver: doing shutdown")
-        os.popen("sudo shutdown --poweroff now").read()
+        subprocess.Popen(["sudo", "shutdown", "--poweroff", "now"], stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL)
         clear_before_shutoff = False
         return True
     else: